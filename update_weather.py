@@ -1,14 +1,34 @@
-import requests
-import pandas as pd
+import orjson
+import requests_cache
+from requests.adapters import HTTPAdapter, Retry
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import os
 import sys
 
+# numpy/pandas/pyarrow/numba are imported inside the functions that use
+# them, so startup (and an early exit on a missing API key) doesn't pay
+# their module-load cost.
+
 # --- CONFIGURATION ---
 API_KEY = os.environ.get("TOMORROW_API_KEY")
-HISTORY_START_YEAR = 2021 
+HISTORY_START_YEAR = 2021
+BASE_TEMP = 18.33  # HDD/CDD balance point, degrees C
+FILE_NAME = "US_AGGREGATE_NATGAS.csv"
+CACHE_DIR = ".cache_weather"
+
+# Shared session so the per-city calls reuse keep-alive sockets instead of
+# paying a fresh TCP+TLS handshake each time; pool_maxsize covers one
+# concurrent connection per city. The sqlite-backed cache makes re-runs
+# within the TTL local hits: 30 min for forecasts, 24 h for the archive.
+SESSION = requests_cache.CachedSession(
+    '.http_cache', backend='sqlite', expire_after=1800,
+    urls_expire_after={'archive-api.open-meteo.com/*': 86400})
+SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8,
+                                      max_retries=Retry(total=3, backoff_factor=0.3)))
 
-LOCATIONS = [
+_LOCATIONS = [
     {"name": "Chicago", "lat": 41.8781, "lon": -87.6298, "weight": 0.35},
     {"name": "New York", "lat": 40.7128, "lon": -74.0060, "weight": 0.30},
     {"name": "Denver",   "lat": 39.7392, "lon": -104.9903, "weight": 0.15}, # Fixed typo here
@@ -16,115 +36,283 @@ LOCATIONS = [
     {"name": "Atlanta",  "lat": 33.7490, "lon": -84.3880,  "weight": 0.10}
 ]
 
-def fetch_data():
-    print("--- Starting Data Fetch (5-Year Scope) ---")
-    
-    # 1. FETCH HISTORY (Open-Meteo)
-    end_date = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
-    start_date = f"{HISTORY_START_YEAR}-01-01"
-    
-    daily_hist = pd.DataFrame()
-    try:
-        hist_frames = []
-        for loc in LOCATIONS:
+# Frozen struct-of-arrays view of the table above: the hot paths index these
+# instead of re-reading dicts. Plain tuples so import stays numpy-free;
+# fetch_all turns WEIGHTS into the matmul vector on demand.
+NAMES = tuple(loc['name'] for loc in _LOCATIONS)
+LATS = tuple(loc['lat'] for loc in _LOCATIONS)
+LONS = tuple(loc['lon'] for loc in _LOCATIONS)
+WEIGHTS = tuple(loc['weight'] for loc in _LOCATIONS)
+assert abs(sum(WEIGHTS) - 1.0) < 1e-9, "LOCATIONS weights must sum to 1"
+
+def _fetch_history(start_date, end_date):
+    # Open-Meteo accepts comma-separated coordinates and answers with one
+    # series per city, so the whole history phase is a single round trip.
+    # The archive is immutable except for the trailing few days, so the
+    # aligned series are cached on disk as one wide frame (a column per
+    # city) and only the dates we don't have yet are fetched.
+    import pandas as pd
+
+    cache_path = os.path.join(CACHE_DIR, "history.parquet")
+    cached = None
+    if os.path.exists(cache_path):
+        cached = pd.read_parquet(cache_path)
+        # fromisoformat is the C fast path for a single ISO date
+        start_date = (datetime.fromisoformat(cached['time'].max()) + timedelta(days=1)).strftime('%Y-%m-%d')
+
+    fresh = None
+    if start_date <= end_date:  # ISO dates compare lexicographically
+        # A failed delta fetch must not throw away the years of history we
+        # already have on disk, so network errors degrade to cached-only.
+        try:
             url = "https://archive-api.open-meteo.com/v1/archive"
             params = {
-                "latitude": loc['lat'], 
-                "longitude": loc['lon'], 
-                "start_date": start_date, 
-                "end_date": end_date, 
+                "latitude": ','.join(map(str, LATS)),
+                "longitude": ','.join(map(str, LONS)),
+                "start_date": start_date,
+                "end_date": end_date,
                 "daily": "temperature_2m_mean"
             }
-            r = requests.get(url, params=params, timeout=10)
-            data = r.json()
-            
-            if 'daily' in data:
-                df = pd.DataFrame({
-                    'time': data['daily']['time'],
-                    'temp': data['daily']['temperature_2m_mean']
-                })
-                df['weight'] = loc['weight']
-                hist_frames.append(df)
-        
-        if hist_frames:
-            full_hist = pd.concat(hist_frames)
-            full_hist['weighted_temp'] = full_hist['temp'] * full_hist['weight']
-            daily_hist = full_hist.groupby('time')['weighted_temp'].sum().reset_index()
-            daily_hist.rename(columns={'weighted_temp': 'avg_temp'}, inplace=True)
-            print(f"History fetched: {len(daily_hist)} days ({HISTORY_START_YEAR}-Present).")
-    except Exception as e:
-        print(f"History Error: {e}")
-
-    # 2. FETCH FORECAST (Tomorrow.io)
-    daily_fore = pd.DataFrame()
-    if API_KEY:
+            r = SESSION.get(url, params=params, timeout=10)
+            # orjson parses the ~200 KB numeric payload several times faster
+            # than the stdlib json that r.json() would use
+            data = orjson.loads(r.content)
+
+            if isinstance(data, dict):
+                data = [data]  # a single-city response isn't wrapped in a list
+            if all('daily' in d for d in data):
+                fresh = pd.DataFrame({'time': data[0]['daily']['time']})
+                for name, d in zip(NAMES, data):
+                    fresh[name] = d['daily']['temperature_2m_mean']
+        except Exception as e:
+            print(f"History delta fetch failed, using cached data only: {e}")
+
+    frames = [f for f in (cached, fresh) if f is not None]
+    if not frames:
+        return None
+    df = pd.concat(frames, ignore_index=True).drop_duplicates('time', keep='last')
+    if fresh is not None:
+        # The archive serves null temperatures for the trailing few days until
+        # they are finalized. Persist only up to the last fully-populated date
+        # so the next run re-requests the preliminary tail once it backfills,
+        # instead of freezing the nulls into the cache forever.
+        complete = df[list(NAMES)].notna().all(axis=1)
+        trim = len(df) - 1
+        while trim >= 0 and not complete.iloc[trim]:
+            trim -= 1
+        if trim >= 0:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            df.iloc[:trim + 1].to_parquet(cache_path, compression='zstd')
+    return df
+
+def _fetch_forecast_one(i):
+    url = f"https://api.tomorrow.io/v4/weather/forecast?location={LATS[i]},{LONS[i]}&apikey={API_KEY}"
+    r = SESSION.get(url, headers={"accept": "application/json"}, timeout=10)
+    if r.status_code != 200:
+        return []
+    return orjson.loads(r.content).get('timelines', {}).get('daily', [])
+
+def fetch_all():
+    import numpy as np
+    import pandas as pd
+
+    print("--- Starting Data Fetch (5-Year Scope) ---")
+
+    end_date = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
+    start_date = f"{HISTORY_START_YEAR}-01-01"
+
+    # The bulk history call and all forecast calls go out in one batch, so
+    # total fetch time is roughly the slowest single round trip. Weighted
+    # sums accumulate straight into two flat date-keyed accumulators (one
+    # hash lookup per update, no per-date inner dict); the final DataFrame
+    # is materialized exactly once at the end.
+    wtemp = defaultdict(float)
+    wsum = defaultdict(float)
+    with ThreadPoolExecutor(max_workers=1 + len(NAMES)) as ex:
+        hist_fut = ex.submit(_fetch_history, start_date, end_date)
+        fore_futs = [ex.submit(_fetch_forecast_one, i) for i in range(len(NAMES))] if API_KEY else []
+
+        # 1. HISTORY (Open-Meteo) — aggregation stays single-threaded after
+        # the futures resolve, so no locks needed
         try:
-            fore_map = {}
-            for loc in LOCATIONS:
-                url = f"https://api.tomorrow.io/v4/weather/forecast?location={loc['lat']},{loc['lon']}&apikey={API_KEY}"
-                r = requests.get(url, headers={"accept": "application/json"}, timeout=10)
-                if r.status_code == 200:
-                    timelines = r.json().get('timelines', {}).get('daily', [])
-                    for day in timelines:
-                        dt = day['time'].split('T')[0]
-                        temp = day['values'].get('temperatureAvg', 0)
-                        fore_map[dt] = fore_map.get(dt, 0) + (temp * loc['weight'])
-            
-            if fore_map:
-                daily_fore = pd.DataFrame(list(fore_map.items()), columns=['time', 'avg_temp'])
-                print(f"Forecast fetched: {len(daily_fore)} days.")
+            hist = hist_fut.result()
+            if hist is not None:
+                # Columns are already date-aligned, so the weighted sums are
+                # (n_days, 5) x (5,) matmuls dispatched to BLAS. Null temps
+                # (the archive's preliminary tail) are masked out and the
+                # per-date weight shrinks with them, mirroring how wsum
+                # renormalizes the forecast loop; all-null dates are dropped.
+                T = hist[list(NAMES)].to_numpy(dtype=np.float32)
+                w = np.asarray(WEIGHTS, dtype=np.float32)
+                valid = ~np.isnan(T)
+                acc = np.where(valid, T, 0.0) @ w
+                aws = valid.astype(np.float32) @ w
+                for dt, v, aw in zip(hist['time'], acc, aws):
+                    if aw > 0:
+                        wtemp[dt] = float(v)
+                        wsum[dt] = float(aw)
+            print(f"History fetched: {len(wtemp)} days ({HISTORY_START_YEAR}-Present).")
+        except Exception as e:
+            print(f"History Error: {e}")
+
+        # 2. FORECAST (Tomorrow.io) — a forecast value replaces any history
+        # entry for the same date, like the old keep='last' merge did
+        try:
+            fore_dates = set()
+            for i, fut in enumerate(fore_futs):
+                weight = WEIGHTS[i]
+                for day in fut.result():
+                    dt = day['time'].split('T')[0]
+                    if dt not in fore_dates:
+                        fore_dates.add(dt)
+                        wtemp[dt] = 0.0
+                        wsum[dt] = 0.0
+                    temp = day['values'].get('temperatureAvg', 0)
+                    wtemp[dt] += temp * weight
+                    wsum[dt] += weight
+            if fore_dates:
+                print(f"Forecast fetched: {len(fore_dates)} days.")
         except Exception as e:
             print(f"Forecast Error: {e}")
 
-    # 3. MERGE
-    df_final = pd.concat([daily_hist, daily_fore]) if not daily_hist.empty else daily_fore
-    if not df_final.empty:
-        df_final = df_final.drop_duplicates(subset='time', keep='last').sort_values('time')
-    
-    return df_final
+    if not wtemp:
+        return pd.DataFrame()
+    times = sorted(wtemp)
+    return pd.DataFrame({
+        'time': times,
+        'avg_temp': [wtemp[dt] / wsum[dt] for dt in times]
+    })
+
+def _numpy_ohlcv(t):
+    import numpy as np
+    # Comparisons (not np.maximum) so a NaN temp yields hdd/cdd of 0
+    # rather than propagating — the same false-branch result the
+    # compiled kernel's if/else produces
+    hdd = np.where(t < BASE_TEMP, BASE_TEMP - t, 0.0)
+    cdd = np.where(t > BASE_TEMP, t - BASE_TEMP, 0.0)
+    return t, t + 2, t - 2, hdd, (cdd * 10).astype(np.int64)
+
+def _ohlcv_loop(t):
+    # Compiled HDD/CDD kernel: same results as the numpy fallback above
+    # (including hdd/cdd of 0 for NaN temps, since NaN comparisons are
+    # false), but one fused C-speed pass with no intermediate arrays.
+    # Worthwhile once HISTORY_START_YEAR reaches further back (or the data
+    # goes hourly). Defined at module scope (np bound by _get_compute_ohlcv)
+    # because numba's cache=True cannot reload closure-defined functions.
+    n = t.size
+    o = np.empty(n)
+    hi = np.empty(n)
+    lo = np.empty(n)
+    cl = np.empty(n)
+    vol = np.empty(n, np.int64)
+    for i in range(n):
+        ti = t[i]
+        o[i] = ti
+        hi[i] = ti + 2
+        lo[i] = ti - 2
+        cl[i] = BASE_TEMP - ti if ti < BASE_TEMP else 0.0
+        cdd = ti - BASE_TEMP if ti > BASE_TEMP else 0.0
+        vol[i] = int(cdd * 10)
+    return o, hi, lo, cl, vol
+
+# Resolved lazily so import never pays for numba's startup; the chosen
+# kernel is cached after the first call, and cache=True persists the
+# compile on disk so later runs skip it too.
+_ohlcv_kernel = None
+
+def _get_compute_ohlcv():
+    global _ohlcv_kernel, np
+    if _ohlcv_kernel is None:
+        _ohlcv_kernel = _numpy_ohlcv
+        try:
+            import numpy as np
+            from numba import njit
+            _ohlcv_kernel = njit(cache=True)(_ohlcv_loop)
+        except ImportError:
+            pass
+    return _ohlcv_kernel
 
 def generate_files(df):
     if df.empty: return
+    import numpy as np
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
 
-    hdds = []
-    dates = []
-    
-    for _, row in df.iterrows():
-        hdd = max(0, 18.33 - row['avg_temp'])
-        dt_obj = datetime.strptime(row['time'], "%Y-%m-%d")
-        unix_ms = int(dt_obj.timestamp() * 1000)
-        hdds.append(str(round(hdd, 2)))
-        dates.append(str(unix_ms))
+    # Vectorized transform: one pass over the whole series instead of
+    # boxing every value through iterrows
+    t = df['avg_temp'].to_numpy(dtype=np.float64)
+    o, hi, lo, hdd, vol = _get_compute_ohlcv()(t)
+    # An explicit format keeps the parse on pandas' C fast path, and
+    # cache=True dedupes repeated strings before parsing
+    dt_idx = pd.to_datetime(df['time'], format='%Y-%m-%d', cache=True)
+
+    # pyarrow serializes the columns with its multithreaded C++ csv writer;
+    # the table is built zero-copy from the numpy arrays, no row loop at all
+    time_iso = dt_idx.dt.strftime('%Y-%m-%dT00:00:00Z').to_numpy()
+    table = pa.table({
+        'time': time_iso,
+        'open': o.round(2),
+        'high': hi.round(2),
+        'low': lo.round(2),
+        'close': hdd.round(2),
+        'volume': vol
+    })
+    # pyarrow quotes the header row even with quoting_style='none', so write
+    # the header ourselves to keep the file byte-compatible with the old format
+    with open(FILE_NAME, 'wb') as f:
+        f.write(b'time,open,high,low,close,volume\n')
+        pacsv.write_csv(table, f,
+                        pacsv.WriteOptions(include_header=False, quoting_style='none'))
+    print(f"Generated {FILE_NAME} ({len(t)} rows)")
+
+    # np.char.mod is a C-level printf across the whole array; joining without
+    # spaces also keeps the literal inside Pine's character budget.
+    # Timestamps ship as one 13-digit base plus small day offsets rather than
+    # ~13 digits per date, cutting that array's payload roughly 4x.
+    unix_ms = dt_idx.astype('datetime64[ms]').astype('int64').to_numpy()
+    base_ms = int(unix_ms[0])
+    offset_strs = ((unix_ms - base_ms) // 86_400_000).astype(np.int32).astype(str)
+    hdd_strs = np.char.mod('%.2f', hdd)
 
     # --- UPDATED TEMPLATE WITH AUTO-SCALING LOGIC ---
     pine_content = f"""// --- PASTE INTO PINE EDITOR ---
 // Data Range: {HISTORY_START_YEAR} to {datetime.now().strftime('%Y-%m-%d')}
 // Context: 5-Year History + 14-Day Forecast + AutoScaling
-var float[] hdd_data = array.from({', '.join(hdds)})
-var int[] time_data = array.from({', '.join(dates)})
+var float[] hdd_data = array.from({','.join(hdd_strs)})
+// Dates are consecutive days, so ship one base timestamp plus day offsets
+var int base_ms = {base_ms}
+var int[] day_offsets = array.from({','.join(offset_strs)})
 
 // --- RENDERING LOGIC ---
+// Build the lookup once on the first bar; every later bar is an O(1)
+// map.get instead of scanning the whole array
+var map<int, float> hdd_map = map.new<int, float>()
+if barstate.isfirst
+    for i = 0 to array.size(day_offsets) - 1
+        map.put(hdd_map, base_ms + array.get(day_offsets, i) * 86400000, array.get(hdd_data, i))
+
 var float current_hdd = na
 int bar_time = time
-int array_len = array.size(time_data)
+int array_len = array.size(day_offsets)
 
 // Auto-Scale: Calculate how many milliseconds are in *one bar* of your current chart
 int ms_per_bar = time - time[1]
 
-// 1. Historical Alignment
-for i = 0 to array_len - 1
-    int t_data = array.get(time_data, i)
-    // Fuzzy Match: Check if data fits in this bar's window
-    if math.abs(bar_time - t_data) < (ms_per_bar / 2)
-        current_hdd := array.get(hdd_data, i)
-        break
+// 1. Historical Alignment: snap the bar's open time to the NEAREST UTC
+// midnight (like the old fuzzy match) so sessions opening late in the UTC
+// day key to the day they represent, not the previous one
+int day_key = math.round(bar_time / 86400000.0) * 86400000
+float mapped_hdd = map.get(hdd_map, day_key)
+if not na(mapped_hdd)
+    current_hdd := mapped_hdd
 
 plot(current_hdd, title="Historical HDD", color=color.blue, style=plot.style_columns, linewidth=2)
 
 // 2. Future Projection (Auto-Scaled)
 if barstate.islast
     for i = 0 to array_len - 1
-        int t_data = array.get(time_data, i)
+        int t_data = base_ms + array.get(day_offsets, i) * 86400000
         float hdd_val = array.get(hdd_data, i)
         if t_data > bar_time
             // Calculate bars forward based on CURRENT TIMEFRAME
@@ -140,5 +328,5 @@ if barstate.islast
     print("Generated pine_code.txt with full history and auto-scaling")
 
 if __name__ == "__main__":
-    df = fetch_data()
+    df = fetch_all()
     generate_files(df)